@@ -15,7 +15,7 @@ __email__ = "p.lewis@ucl.ac.uk"
 __status__ = "Production"
 
 import numpy as np
-import sys,os,datetime,math,ast,glob,resource
+import sys,os,datetime,math,ast,glob,resource,fnmatch,tempfile,shutil
 from pyhdf import SD
 from optparse import OptionParser
 #the two imports below are needed if you want to save the output in ENVI format, but they conflict with the netcdf code, so commented out.
@@ -25,15 +25,42 @@ from subprocess import check_call
 import netCDF4 as nc
 import logging
 from scipy import stats
-import cPickle as pickle
-import zlib
-import pp
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import threading
 import numpy.ma as ma
+try:
+  # numba is optional: we fall back to numpy if it is not there
+  import numba
+  from numba import njit, prange
+  hasNumba = True
+except ImportError:
+  hasNumba = False
+  prange = xrange
+  def njit(*args,**kwargs):
+    return lambda f: f
+
+# the numba threading layers are not all thread safe (the
+# workqueue layer aborts if two threads run parallel kernels at
+# once), so calls of the parallel kernels below hold this
+kernelLock = threading.Lock()
+
+# cache of insensitive_glob results, keyed on pattern
+globCache = {}
 
 def insensitive_glob(pattern):
-    """ From: http://stackoverflow.com/questions/8151300/ignore-case-in-glob-on-linux
+    """ 
+    case insensitive glob of a filename (or other) pattern
 
-    form a case insensitive glob version of a filename (or other) pattern
+    The pattern is matched one path component at a time, listing
+    each candidate directory once and comparing lower-cased names with
+    fnmatch. This replaces the expansion of every letter into a [xX] 
+    bracket expression (from
+    http://stackoverflow.com/questions/8151300/ignore-case-in-glob-on-linux)
+    which made the glob patterns very expensive to match.
+
+    Results are cached on the pattern, so repeated calls don't
+    go back to the filesystem.
 
     Parameters
     ----------
@@ -42,7 +69,7 @@ def insensitive_glob(pattern):
 
     Returns
     -------
-    npattern : a string (filename) that is case insensitive
+    files : list of matching filenames
 
     Examples
     --------
@@ -53,9 +80,458 @@ def insensitive_glob(pattern):
     '/data/geospatial_11/plewis/h25v06/data/MCD43A1.A2001001.h25v06.005.2006360202416.hdf'
 
     """
-    def either(c):
-        return '[%s%s]'%(c.lower(),c.upper()) if c.isalpha() else c
-    return glob.glob(''.join(map(either,pattern)))
+    if pattern not in globCache:
+      parts = pattern.split('/')
+      if parts[0] == '':
+        candidates = ['/']
+      else:
+        candidates = ['']
+      for part in parts:
+        if part == '':
+          continue
+        if part in ['.','..']:
+          candidates = [os.path.join(c,part) for c in candidates]
+          continue
+        lpart = part.lower()
+        matches = []
+        for c in candidates:
+          try:
+            names = os.listdir(c or '.')
+          except OSError:
+            # not a directory
+            continue
+          for name in names:
+            # as glob, * does not match hidden files
+            if name.startswith('.') and not part.startswith('.'):
+              continue
+            if fnmatch.fnmatchcase(name.lower(),lpart):
+              matches.append(os.path.join(c,name))
+        candidates = matches
+      globCache[pattern] = candidates
+    # return a copy as callers may extend it
+    return list(globCache[pattern])
+
+@njit(parallel=True,fastmath=True)
+def decodeQa(brdf_qa,snow_qa,anc_qa,band_qa,lut):
+    """
+    Decode the MCD43A2 QA layers in a single pass over the image
+
+    A pixel is good if BRDF_Albedo_Quality and Snow_BRDF_Albedo
+    are not fill (255), it is not deep ocean (land category 7) and the
+    quality of the first two bands (the lowest two nibbles of
+    BRDF_Albedo_Band_Quality) is < 4. The poorest (max) of
+    these two is used as the band quality.
+
+    Parameters
+    ----------
+    brdf_qa  : integer array [ns,nl] : BRDF_Albedo_Quality
+    snow_qa  : integer array [ns,nl] : Snow_BRDF_Albedo
+    anc_qa   : integer array [ns,nl] : BRDF_Albedo_Ancillary
+    band_qa  : integer array [ns,nl] : BRDF_Albedo_Band_Quality
+    lut      : float array [16]
+               weight for each quality value, i.e. backupscale ** arange(16)
+
+    Returns
+    -------
+    goodData     : bool array [ns,nl]
+    snow_mask    : bool array [ns,nl]
+    no_snow_mask : bool array [ns,nl]
+    land         : uint8 array [ns,nl] : land / water category (bits 4-7)
+    band_quality : uint8 array [ns,nl]
+    weight       : float array [ns,nl] : lut[band_quality]
+    """
+    ns,nl = band_qa.shape
+    good = np.empty((ns,nl),dtype=np.bool_)
+    snow_mask = np.empty((ns,nl),dtype=np.bool_)
+    no_snow_mask = np.empty((ns,nl),dtype=np.bool_)
+    land = np.empty((ns,nl),dtype=np.uint8)
+    band_quality = np.empty((ns,nl),dtype=np.uint8)
+    weight = np.empty((ns,nl),dtype=lut.dtype)
+    for s in prange(ns):
+      for l in range(nl):
+        q = band_qa[s,l]
+        bq = max(q & 0xF,(q >> 4) & 0xF)
+        band_quality[s,l] = bq
+        weight[s,l] = lut[bq]
+        sq = snow_qa[s,l]
+        snow_mask[s,l] = sq == 1
+        no_snow_mask[s,l] = sq == 0
+        lc = (anc_qa[s,l] & 0xF0) >> 4
+        land[s,l] = lc
+        good[s,l] = brdf_qa[s,l] != 255 and sq != 255 and lc != 7 and bq < 4
+    return good,snow_mask,no_snow_mask,land,band_quality,weight
+
+@njit(parallel=True,cache=True)
+def shrinkKernel(fdata,shrink,odata):
+    """
+    Mean over shrink x shrink blocks of fdata, ignoring zero values
+
+    Parameters
+    ----------
+    fdata  : array [ns,nl]
+             data to be shrunk
+    shrink : integer
+             shrink factor
+    odata  : float array [ns/shrink,nl/shrink]
+             (preallocated) output array
+
+    Returns
+    -------
+    odata : float array [ns/shrink,nl/shrink]
+            block mean of the non-zero values (0 if there are none)
+    """
+    for i in prange(odata.shape[0]):
+      for j in range(odata.shape[1]):
+        s = 0.
+        n = 0
+        for di in range(shrink):
+          for dj in range(shrink):
+            v = fdata[i*shrink+di,j*shrink+dj]
+            if v != 0:
+              s += v
+              n += 1
+        if n > 0:
+          odata[i,j] = s/n
+        else:
+          odata[i,j] = 0.
+    return odata
+
+@njit(parallel=True,fastmath=True)
+def welfordUpdate(mean,m2,x,r,q):
+    """
+    Weighted incremental (West) update of mean and M2 in place
+
+    For a new sample x with weight w and previous total weight n:
+
+        delta = x - mean
+        mean += w/(n+w) * delta
+        m2 += w*n/(n+w) * delta^2
+
+    Parameters
+    ----------
+    mean : float array [nb,ns,nl,3] : weighted mean (updated)
+    m2   : float array [nb,ns,nl,3] : sum of w * (x - mean)^2 (updated)
+    x    : float array [nb,ns,nl,3] : new sample
+    r    : float array [ns,nl] : w/(n+w) (0 if n+w is 0)
+    q    : float array [ns,nl] : w*n/(n+w)
+
+    Returns
+    -------
+    None
+    """
+    nb,ns,nl,nk = mean.shape
+    for s in prange(ns):
+      for b in range(nb):
+        for l in range(nl):
+          for k in range(nk):
+            delta = x[b,s,l,k] - mean[b,s,l,k]
+            mean[b,s,l,k] += r[s,l]*delta
+            m2[b,s,l,k] += q[s,l]*delta*delta
+
+@njit(parallel=True,cache=True)
+def shrinkSdKernel(fdata,sdata,shrink,odata,osdata):
+    """
+    Inverse variance weighted mean over shrink x shrink blocks
+    of fdata, ignoring zero values (or zero sd)
+
+    For the values in each block with weight v = 1/sdata^2:
+
+        odata = sum(fdata * v) / sum(v)
+        osdata = sqrt(n / sum(v))
+
+    Parameters
+    ----------
+    fdata  : float array [ns,nl]
+             data to be shrunk
+    sdata  : float array [ns,nl]
+             sd of fdata
+    shrink : integer
+             shrink factor
+    odata  : float array [ns/shrink,nl/shrink]
+             (preallocated) output array for the mean
+    osdata : float array [ns/shrink,nl/shrink]
+             (preallocated) output array for the sd
+
+    Returns
+    -------
+    odata,osdata : float arrays [ns/shrink,nl/shrink]
+                   (0 where there are no values)
+    """
+    for i in prange(odata.shape[0]):
+      for j in range(odata.shape[1]):
+        sfv = 0.
+        sv = 0.
+        n = 0
+        for di in range(shrink):
+          for dj in range(shrink):
+            f = fdata[i*shrink+di,j*shrink+dj]
+            var = sdata[i*shrink+di,j*shrink+dj]**2
+            if f != 0 and var > 0:
+              sfv += f/var
+              sv += 1./var
+              n += 1
+        if sv > 0:
+          odata[i,j] = sfv/sv
+          osdata[i,j] = np.sqrt(n/sv)
+        else:
+          odata[i,j] = 0.
+          osdata[i,j] = 0.
+    return odata,osdata
+
+# the HDF4 library is not thread safe: pyhdf calls
+# that may run alongside other threads hold this
+hdfLock = threading.Lock()
+
+def readBands(fileName,bands,limits,raw):
+    """
+    Read a window of the given band SDS of an MCD43A1 file into raw
+
+    Each pyhdf call holds hdfLock, so this can run in a thread
+    while other pyhdf reads (e.g. of the QA file) go on.
+
+    Parameters
+    ----------
+    fileName : string
+               MCD43A1 file name
+    bands    : integer array
+               band SDS numbers to read
+    limits   : tuple (s0,ns,l0,nl)
+               window to read
+    raw      : int16 array [nBands,ns,nl,3]
+               output array
+
+    Returns
+    -------
+    raw
+    """
+    s0,ns,l0,nl = limits
+    with hdfLock:
+      hdf = SD.SD(fileName)
+    try:
+      # loop over bands: pyhdf needs one select per SDS
+      for i in range(len(bands)):
+        with hdfLock:
+          # Lewis: ensure this is an int
+          # copy straight into raw: no intermediate array per band
+          raw[i] = hdf.select(int(bands[i])).get(start=[s0,l0,0],count=[ns,nl,3])
+    finally:
+      with hdfLock:
+        hdf.end()
+    return raw
+
+def startReadBands(fileName,bands,limits,raw):
+    """
+    Start readBands in a (daemon) thread, so the band data are
+    read while the caller deals with the QA
+
+    Only the requested bands and window are read.
+
+    Parameters
+    ----------
+    as readBands
+
+    Returns
+    -------
+    wait : function of no arguments that waits for the
+           read and returns raw (or raises its error)
+    """
+    result = {}
+    def read():
+      try:
+        result['raw'] = readBands(fileName,bands,limits,raw)
+      except Exception as e:
+        result['error'] = e
+    thread = threading.Thread(target=read)
+    thread.daemon = True
+    thread.start()
+    def wait():
+      thread.join()
+      if 'error' in result:
+        raise result['error']
+      return result['raw']
+    return wait
+
+def readAlbedo(args):
+    """
+    Read one MODIS A1/A2 file pair with getModisAlbedo, using
+    the snow, no_snow and bands settings of al (as translate)
+
+    This is a module-level function so that it can be used
+    by a multiprocessing.Pool
+
+    Parameters
+    ----------
+    args : tuple (al,fileName,QaFile,sdim,backupscale)
+           where al is a prep_modis instance
+
+    Returns
+    -------
+    dictionary from al.getModisAlbedo()
+    """
+    al,fileName,QaFile,sdim,backupscale = args
+    return al.getModisAlbedo(fileName,QaFile,snow=al.snow,no_snow=al.no_snow,\
+                             bands=al.bands,sdim=sdim,backupscale=backupscale)
+
+def sharedZeros(shape,dtype=np.float32):
+    """
+    Zeroed array in shared memory
+
+    The buffer is inherited (not copied) by multiprocessing
+    workers forked after it is allocated, so they can write
+    into it directly.
+
+    Parameters
+    ----------
+    shape : tuple
+            array shape
+    dtype : numpy dtype
+
+    Returns
+    -------
+    numpy array of shape, dtype in a multiprocessing.RawArray
+    """
+    dtype = np.dtype(dtype)
+    buf = multiprocessing.RawArray('b',int(np.prod(shape))*dtype.itemsize)
+    return np.frombuffer(buf,dtype=dtype).reshape(shape)
+
+def shareThreads(nproc):
+    """
+    Limit the threads the parallel numba kernels use in this
+    process to its share of the CPUs when there are nproc worker
+    processes (so nproc workers dont each use all of them)
+
+    This is a multiprocessing.Pool initializer.
+
+    Parameters
+    ----------
+    nproc : integer
+            number of worker processes
+    """
+    nthreads = max(1,multiprocessing.cpu_count()//max(1,nproc))
+    # for anything that starts numba afresh
+    os.environ['NUMBA_NUM_THREADS'] = str(nthreads)
+    if hasNumba and hasattr(numba,'set_num_threads'):
+      numba.set_num_threads(min(nthreads,numba.config.NUMBA_NUM_THREADS))
+
+# set by initAccumulate in each accumulateAlbedo worker
+accumulateAl = None
+accumulators = None
+accumulateLock = None
+
+def initAccumulate(al,sums,lock,nproc=None):
+    """
+    Set the prep_modis instance that accumulateAlbedo uses, the sums
+    it adds into and the lock that guards them (multiprocessing.Pool
+    initializer)
+
+    The workers are forked, so these are inherited rather than
+    pickled with every job.
+
+    Parameters
+    ----------
+    al   : prep_modis instance
+    sums : list of (isSnow,sumData) tuples
+           see prep_modis.addSamples()
+    lock : multiprocessing.Lock
+    nproc : integer (optional)
+            number of worker processes, see shareThreads()
+    """
+    global accumulateAl,accumulators,accumulateLock
+    if nproc:
+      shareThreads(nproc)
+    accumulateAl = al
+    accumulators = sums
+    accumulateLock = lock
+
+def accumulateAlbedo(args):
+    """
+    Read one MODIS A1/A2 file pair and add it into the sums
+    set by initAccumulate
+
+    This is a module-level function so that it can be used
+    by a multiprocessing.Pool. Only the small items are
+    returned, so the data are never pickled back to the parent.
+
+    Parameters
+    ----------
+    args : tuple (fileName,QaFile,sdim,backupscale)
+           (the prep_modis instance is set by initAccumulate)
+
+    Returns
+    -------
+    dictionary with ``error``, ``land`` (land == 1) and ``nSnow``
+    """
+    return accumulateData(accumulateAl,readAlbedo((accumulateAl,)+tuple(args)))
+
+def accumulateData(al,thisData):
+    """
+    Add data from getModisAlbedo into the sums set by initAccumulate
+
+    Parameters
+    ----------
+    al       : prep_modis instance
+    thisData : dictionary from al.getModisAlbedo()
+
+    Returns
+    -------
+    dictionary with ``error``, ``land`` (land == 1) and ``nSnow``
+    """
+    if thisData['error']:
+      return dict(error=True)
+    al.addSamples(accumulators,thisData,lock=accumulateLock)
+    return dict(error=False,land=(thisData['land'] == 1),nSnow=np.count_nonzero(thisData['snow_mask']))
+
+def readAhead(func,jobs):
+    """
+    Generate func(job) for each job in turn, working out the
+    next one in a background thread while the caller uses this one
+
+    Only one call of func runs at a time (so it is safe for
+    pyhdf reads) and at most two results are held in memory.
+
+    Parameters
+    ----------
+    func : function of one argument
+    jobs : list of arguments for func
+
+    Returns
+    -------
+    generator of func(job)
+    """
+    pool = ThreadPool(1)
+    try:
+      pending = None
+      for job in jobs:
+        result = pool.apply_async(func,(job,))
+        if pending is not None:
+          yield pending.get()
+        pending = result
+      if pending is not None:
+        yield pending.get()
+    finally:
+      pool.terminate()
+
+def runPart(args):
+    """
+    Process one doy and image part with al.processPart in a worker process
+
+    This is a module-level function so that it can be used
+    by a multiprocessing.Pool. The worker reads its files
+    serially (al.nproc = 1) as a pool worker cannot
+    start a pool of its own.
+
+    Parameters
+    ----------
+    args : tuple (al,doy,p,isRST)
+           where al is a prep_modis instance
+
+    Returns
+    -------
+    None
+    """
+    al,doy,p,isRST = args
+    al.nproc = 1
+    return al.processPart(doy,p,isRST)
 
 class dummy():
     def __init__(self):
@@ -106,6 +582,8 @@ class prep_modis():
 
         ``no_snow`` :  output no_snow data
 
+        ``nproc`` : number of processes to use (default: number of CPUs)
+
 
     """    
     def __init__(self,inputs=None):
@@ -121,9 +599,18 @@ class prep_modis():
 
         #constructor
         self.default_settings(inputs)
+        # QA weight lookup table: backupscale ^ band_quality
+        self.weightLut = np.float32(self.backupscale) ** np.arange(16,dtype=np.float32)
+        # limits on the variance used to clamp the sd (as in prior2Fast)
+        self.minvar = 1e-20
+        self.maxvar = 1.0
  
         self.a1Files = []
         self.a2Files = []
+        self.fileIndex = None
+        self.workspace = None
+        self.workdir = None
+        self.nameCache = {}
 
         # set up logging and opdir
         self.logging = dummy()
@@ -140,6 +627,25 @@ class prep_modis():
           self.a1Files.extend(a1)
           self.a2Files.extend(a2)
 
+    def __getstate__(self):
+        '''
+        Drop the logger when pickling (e.g. to send to a worker process)
+        '''
+        state = self.__dict__.copy()
+        state['logging'] = None
+        return state
+
+    def __setstate__(self,state):
+        '''
+        Restore the logger after unpickling
+        '''
+        self.__dict__.update(state)
+        if self.logfile:
+          self.logging = logging
+        else:
+          self.logging = dummy()
+          self.logging.info = self.logging.error = self.logging.warning = self.no_log
+
     def no_log(self,msg,extra=''):
         '''
         Default logging - put to stderr
@@ -149,7 +655,7 @@ class prep_modis():
 
     def default_settings(self,inputs):
         self.ip = inputs
-        if inputs == None:
+        if inputs is None:
           self.doyList = None
           self.logfile = None
           self.logdir  = 'logs'
@@ -165,6 +671,7 @@ class prep_modis():
           self.backupscale = 0.61803398875 # ^ band_quality
           self.snow    = True 
           self.no_snow = True
+          self.nproc   = multiprocessing.cpu_count()
           return
 
         try:
@@ -183,6 +690,7 @@ class prep_modis():
           self.backupscale = self.ip.backupscale
           self.snow    = self.ip.snow
           self.no_snow = self.ip.no_snow  
+          self.nproc   = getattr(self.ip,'nproc',None) or multiprocessing.cpu_count()
         except:
           self.doyList = self.ip['doyList'] 
           self.logfile = self.ip['logfile']
@@ -199,6 +707,67 @@ class prep_modis():
           self.backupscale = self.ip['backupscale']
           self.snow    = self.ip['snow']
           self.no_snow = self.ip['no_snow']
+          self.nproc   = self.ip.get('nproc') or multiprocessing.cpu_count()
+
+    def getWorkspace(self,nsets,ns,nl):
+        """
+        Zeroed per data set buffers for the kernels and QA of one doy
+
+        The buffers are kept and reused for the next doy, and only
+        reallocated if they are too small. If they would take more than
+        half of the physical memory, they are memory mapped onto files in
+        a scratch directory instead (see releaseWorkspace).
+
+        Parameters
+        ----------
+        nsets : integer
+                number of data sets (years)
+        ns    : integer
+                number of samples
+        nl    : integer
+                number of lines
+
+        Returns
+        -------
+        dictionary of [nsets,ns,nl] arrays:
+          ``f0``, ``f1``, ``f2``, ``weight`` : uint16
+          ``snow``, ``no_snow`` : bool
+          ``land`` : uint8
+        """
+        dtypes = dict(f0=np.uint16,f1=np.uint16,f2=np.uint16,weight=np.uint16,\
+                      snow=bool,no_snow=bool,land=np.uint8)
+        ws = self.workspace
+        if ws is None or ws['f0'].shape[0] < nsets or ws['f0'].shape[1:] != (ns,nl):
+          self.releaseWorkspace()
+          nbytes = nsets*ns*nl*sum(np.dtype(dtypes[k]).itemsize for k in dtypes)
+          try:
+            ram = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+          except (AttributeError,ValueError,OSError):
+            ram = None
+          if ram is not None and nbytes > ram/2:
+            # disk backed: a new memmap (mode w+) is zero filled
+            # (in opdir: /tmp may well be in memory)
+            self.workdir = tempfile.mkdtemp(prefix='albedo_pix.',dir=self.opdir)
+            self.logging.info('... using memory mapped workspace in %s'%self.workdir,extra=self.d)
+            ws = dict((k,np.memmap(os.path.join(self.workdir,k+'.dat'),dtype=dtypes[k],\
+                                   mode='w+',shape=(nsets,ns,nl))) for k in dtypes)
+          else:
+            ws = dict((k,np.zeros((nsets,ns,nl),dtype=dtypes[k])) for k in dtypes)
+          self.workspace = ws
+        else:
+          for k in ws:
+            ws[k][:nsets] = 0
+        return dict((k,ws[k][:nsets]) for k in ws)
+
+    def releaseWorkspace(self):
+        """
+        Free the getWorkspace buffers, and remove any
+        memory mapped files backing them
+        """
+        self.workspace = None
+        if self.workdir is not None:
+          shutil.rmtree(self.workdir,ignore_errors=True)
+          self.workdir = None
 
     def translate(self,filename,QaFile,refl=None,bands=None,data=None):
       '''
@@ -217,32 +786,43 @@ class prep_modis():
         return None
       data['year'] = filename.split('/')[-1].split('.')[1][1:5]
       data['doy'] = filename.split('/')[-1].split('.')[1][5:]
-      data['data'] = (1000*data['data']).astype(np.uint16)
-      data['weight'] = (1000*data['weight']).astype(np.uint16)
+      # the data are the raw MODIS integers, which are already
+      # in units of scale = 1/1000
+      data['data'] = data['data'].astype(np.uint16)
+      # scale the weight to uint16 in place, avoiding a float64 temporary
+      # (unless its already done, e.g. weight passed in from a previous band)
+      if data['weight'].dtype != np.uint16:
+        np.multiply(data['weight'],np.float32(1000),out=data['weight'],casting='same_kind')
+        np.rint(data['weight'],out=data['weight'])
+        data['weight'] = data['weight'].astype(np.uint16)
       return data
 
-    def testing(self):
+    def testing(self,data):
       # organise the data by doy for all years
       # we need to get the data ordered so that year varies first
       # then doy then anything else
-      iofile = self.opdir + '/'+ self.product+'.'+self.tile+'.'+data['doy']+'_base.pkl'
-      # and by band
-      fp = [None]*len(self.bands)
-      files = [None]*len(self.bands)
-      for i,b in enumerate(self.bands):
-        iofiles = iofile.replace('base.pkl','band_%08d.bin'%b)
-        if iofiles == files[i]:
-          self.logging.info('appending to %s ...'%iofiles,extra=self.d)
-        else:
-          if fp[i] != None:
-            fp[i].close()
-          self.logging.info('writing to %s ...'%iofiles,extra=self.d)
-          fp[i] = open(iofiles, 'wb')
-        np.save(fp[i], data['data'][:,i])
-      del data['data']
+      iofile = self.opdir + '/'+ self.product+'.'+self.tile+'.'+data['doy']+'.'+data['year']+'_base.nc'
       self.logging.info('writing to %s ...'%iofile,extra=self.d) 
-      fp = open(iofile, 'wb+')
-      pickle.dump(data, fp)
+      s0,ns,l0,nl = data['limits']
+      nb = data['nb']
+      ncfile = nc.Dataset(iofile,'w',format = 'NETCDF4')
+      ncfile.createDimension('param',3)
+      ncfile.createDimension('nb',nb)
+      ncfile.createDimension('ns',ns)
+      ncfile.createDimension('nl',nl)
+      # data[0-3,nb,:,:]: chunk by band so each band can be read on its own
+      v = ncfile.createVariable('data','u2',('param','nb','ns','nl'),zlib=True,complevel=1,\
+                                chunksizes=(3,1,min(ns,256),min(nl,256)))
+      v.set_var_chunk_cache(size=64*1024*1024)
+      v[:] = data['data']
+      for k in ['mask','snow_mask','no_snow_mask','land']:
+        v = ncfile.createVariable(k,'u1',('ns','nl'),zlib=True)
+        v[:] = data[k].astype(np.uint8)
+      v = ncfile.createVariable('weight','u2',('ns','nl'),zlib=True)
+      v[:] = data['weight']
+      for k in ['year','doy','ns','nl','nb','limits','scale']:
+        ncfile.setncattr(k,data[k])
+      ncfile.close()
       return True
 
     def set_logging(self,logdir,logfile):
@@ -296,20 +876,10 @@ class prep_modis():
         yearlist : unique, sorted list of years
 
         """
-        doyList=[]
-        yearList=[]
-        
-        for file in list1:
-            fileBaseName = os.path.basename(file)
-            year=fileBaseName[9:13]
-            doy=fileBaseName[13:16]
-            if doyList.count(doy) == 0:
-                doyList.append(doy)
-            if yearList.count(year) == 0:
-                yearList.append(year)
-
-        yearList = np.sort(np.unique(yearList))
-        doyList = np.sort(np.unique(doyList))
+        names = [os.path.basename(file) for file in list1]
+        yearList = np.array(sorted({name[9:13] for name in names}))
+        doyList = np.array(sorted({name[13:16] for name in names}))
+
         self.logging.info(str(yearList),extra=self.d)
         self.logging.info(str(doyList),extra=self.d)
 
@@ -342,6 +912,67 @@ class prep_modis():
 
         return this
 
+    def sampleNames(self,nb):
+        """
+        Return the output band names for nb bands, and the MEAN and SD
+        subsets of them. These only depend on nb, so are cached.
+
+        Parameters
+        ----------
+
+        nb  : long
+              number of bands
+
+        Returns
+        -------
+
+        (bNames,meanNames,sdNames) : tuple of string tuples
+                 all band names (as idSamples), the MEAN names and the SD names
+
+        """
+        if nb not in self.nameCache:
+          bNames = tuple(self.idSamples(nb))
+          meanNames = tuple(b for b in bNames if 'MEAN: ' in b)
+          sdNames = tuple(b for b in bNames if 'SD: ' in b)
+          self.nameCache[nb] = (bNames,meanNames,sdNames)
+        return self.nameCache[nb]
+
+    def indexFiles(self):
+        """
+        Scan srcdir once for the MODIS files of this product, tile and version
+
+        Returns
+        -------
+
+        fileIndex : list of 3 dictionaries, one per supported directory layout
+                    (in order of preference):
+
+                    srcdir/MCD43A1/2000/h18v03/*/*.hdf
+                    srcdir/*.hdf
+                    srcdir/*MCD43A1/2000/*.hdf
+
+                    each keyed on (kind,year,doy) where kind is '1' (A1) or '2' (A2)
+                    and containing a list of file names
+
+        """
+        product = self.product
+        tile = self.tile
+        version = self.version
+        srcdir = self.srcdir
+        fileIndex = [{},{},{}]
+        for kind in ['1','2']:
+          patterns = [srcdir+'/%s%s/*/%s/*/'%(product,kind,tile)+\
+                           '*'+product+kind+'.A*.'+tile+'.'+version+'.*.hdf',\
+                      srcdir+'/'+'*'+product+kind+'.A*.'+tile+'.'+version+'.*.hdf',\
+                      srcdir+'/'+'*'+product+kind+'/*/*.A*.%s.*hdf'%tile]
+          for index,pattern in zip(fileIndex,patterns):
+            for file in insensitive_glob(pattern):
+              # e.g. MCD43A1.A2000049.h18v03.005.2006360202416.hdf
+              date = os.path.basename(file).split('.')[1]
+              key = (kind,date[1:5],date[5:8])
+              index.setdefault(key,[]).append(file)
+        return fileIndex
+
     def getValidFiles(self,yearList,doy):
 
         """       
@@ -376,23 +1007,25 @@ class prep_modis():
         doy = '%03d'%int(doy)
         a1Files = []
         a2Files = []
+        # scan the directories once only
+        if self.fileIndex is None:
+          self.fileIndex = self.indexFiles()
+        layout = self.fileIndex
         for i,year in enumerate(yearList):
                 year = str(yearList[i])
                 # look in e.g. srcdir + '/MCD43A2/2000/h18v03/*/*MCD432.A2000000.h18v03.005.*.hdf'
-                a2 = insensitive_glob(srcdir+'/%s2/%s/%s/*/'%(product,year,tile)+\
-                         '*'+product+'2.A'+year+str(doy)+'.'+tile+'.'+version+'.*.hdf')
-                a1 = insensitive_glob(srcdir+'/%s1/%s/%s/*/'%(product,year,tile)+\
-                         '*'+product+'1.A'+year+str(doy)+'.'+tile+'.'+version+'.*.hdf')
+                a2 = list(layout[0].get(('2',year,doy),[]))
+                a1 = list(layout[0].get(('1',year,doy),[]))
  
                 # look in eg srcdir + '/*MCD43A1.A2000000.h18v03.005.*.hdf'
                 if len(a1) == 0 or len(a2) == 0: 
-                  a2 = insensitive_glob(srcdir+'/'+'*'+product+'2.A'+year+str(doy)+'.'+tile+'.'+version+'.*.hdf')
-                  a1 = insensitive_glob(srcdir+'/'+'*'+product+'1.A'+year+str(doy)+'.'+tile+'.'+version+'.*.hdf')
+                  a2 = list(layout[1].get(('2',year,doy),[]))
+                  a1 = list(layout[1].get(('1',year,doy),[]))
               
                 # look in eg '/*MCD43A2/2000/*.A2000000.h18v03.*hdf'
                 if len(a2) == 0 or len(a1) == 0:
-                  a2.extend(insensitive_glob(self.srcdir+'/'+'*'+self.product+'2/%s/*.A%s%s.%s.*hdf'%(year,year,str(doy),self.tile)))
-                  a1.extend(insensitive_glob(self.srcdir+'/'+'*'+self.product+'1/%s/*.A%s%s.%s.*hdf'%(year,year,str(doy),self.tile)))
+                  a2.extend(layout[2].get(('2',year,doy),[]))
+                  a1.extend(layout[2].get(('1',year,doy),[]))
 
                 if len(a1) == 0 or len(a2) == 0 :
                     self.logging.info( '========',extra=self.d)
@@ -457,6 +1090,33 @@ class prep_modis():
 
         return op
 
+    def readDims(self,QaFile,sdim):
+        """
+        Read the dimensions of a MODIS QA file (MCD43A2) and
+        work out the window that getModisAlbedo would read
+
+        Parameters
+        ----------
+
+        QaFile : string
+                 The HDF filename of the QA datafile
+        sdim   : Long array[4]
+                 [s0,ns,l0,nl] or [-1,-1,-1,-1] for full dataset
+
+        Returns
+        -------
+
+        [s0,ns,l0,nl] : see sortDims()
+
+        """
+        with hdfLock:
+          hdf = SD.SD(QaFile)
+          try:
+            nl,ns = hdf.select(0).dimensions().values()
+          finally:
+            hdf.end()
+        return self.sortDims(sdim,[0,ns,0,nl])
+
     def getModisAlbedo(self,fileName,QaFile,bands=[0,1,2,3,4,5,6],\
                         snow=False,no_snow=True,dataw=None,\
                         sdim=[-1,-1,-1,-1],backupscale=0.61803398875):
@@ -487,7 +1147,8 @@ class prep_modis():
         dictionary : containing
 
         weight    : weight[ns,nl]
-        data:     : data[nb,ns,nl,3]
+        data:     : data[nb,ns,nl,3]     : raw int16 MODIS data
+        scale     : float               : scale to apply to data
         mask:     : mask[ns,nl]                 : True for good data
         snow_mask : snow_mask[ns,nl]    : True for snow
         land      : land[ns,nl]         : 1 for land and only land
@@ -513,83 +1174,95 @@ class prep_modis():
         """
         duff = long(32767)
         oneScale = 1000
-        scale = 1.0/oneScale
+        scale = np.float32(1.0/oneScale)
         nBands = len(bands)
         err=0
         try:
-          if dataw == None:
+          if dataw is None:
             try:
               self.logging.info( '...reading qa... %s'%QaFile,extra=self.d)
             except:
               pass
             # open the QA file
-            hdf = SD.SD(QaFile)
-            sds_1 = hdf.select(0)
-            nl,ns = sds_1.dimensions().values()
+            with hdfLock:
+              hdf = SD.SD(QaFile)
+              sds_1 = hdf.select(0)
+              nl,ns = sds_1.dimensions().values()
             fileDims = [0,ns,0,nl]
             #take a subset if input sdims values require it
             s0,ns,l0,nl = self.sortDims(sdim,fileDims)
+            # read the data for the bands we want in the
+            # background while we deal with the QA
+            self.logging.info( 'reading data... %s'%fileName,extra=self.d)
+            # allocate array for the raw data of all bands
+            raw = np.empty((nBands,ns,nl,3),dtype=np.int16)
+            waitBands = startReadBands(fileName,bands,(s0,ns,l0,nl),raw)
   
-            # BRDF_Albedo_Quality: 255 is a Fill
-            goodData = np.array(sds_1.get(start=[s0,l0],count=[ns,nl])) != 255
-  
-            # Snow_BRDF_Albedo 
-            sds_2 = hdf.select(1)
-            QA = np.array(sds_2.get(start=[s0,l0],count=[ns,nl]))
-            # snow mask is True for snow and False for no snow
-            goodData = goodData & (QA!=255)
-            snow_mask    = QA==1
-            no_snow_mask = QA==0
-            #  BRDF_Albedo_Ancillary
-            #  pull land / sea etc mask 
-            sds_3 = hdf.select(2)
-            QA = np.array(sds_3.get(start=[s0,l0],count=[ns,nl]))
-            # land / water is bits 4-7
-            land = (( 0b11110000 & QA ) >> 4).astype(np.uint8)
-            # dont want deep ocean
-            goodData = goodData & (land != 7)
-
-            #  BRDF_Albedo_Band_Quality 
-            sds_4 = hdf.select(3)
-            QA = np.array(sds_4.get(start=[s0,l0],count=[ns,nl]))
-            band_quality = QA & 0b1111
-            QA = QA >> 4
-            goodData = goodData & (band_quality < 4)
-            #this loop might not be needed ...
-            #might get away with just teh first band ...
-            #for k in range(1,1):
-            band_quality2 = QA & 0b1111
-            goodData = goodData & (band_quality2 < 4)
-            QA = QA >> 4
-            # take the max
-            w = band_quality2>band_quality
-            band_quality[w] = band_quality2[w]
-            hdf.end()
+            # read all of the QA layers, then decode them
+            # (np.asarray: pyhdf already gives us new arrays, so dont copy them)
+            with hdfLock:
+              # BRDF_Albedo_Quality: 255 is a Fill
+              brdf_qa = np.asarray(sds_1.get(start=[s0,l0],count=[ns,nl]))
+              # Snow_BRDF_Albedo 
+              snow_qa = np.asarray(hdf.select(1).get(start=[s0,l0],count=[ns,nl]))
+              #  BRDF_Albedo_Ancillary
+              anc_qa = np.asarray(hdf.select(2).get(start=[s0,l0],count=[ns,nl]))
+              #  BRDF_Albedo_Band_Quality 
+              band_qa = np.asarray(hdf.select(3).get(start=[s0,l0],count=[ns,nl]))
+              hdf.end()
+
+            # weight for each band_quality value
+            if np.all(backupscale == self.backupscale):
+              lut = self.weightLut
+            else:
+              lut = np.float32(backupscale) ** np.arange(16,dtype=np.float32)
+
+            if hasNumba:
+              with kernelLock:
+                goodData,snow_mask,no_snow_mask,land,band_quality,weight = \
+                                      decodeQa(brdf_qa,snow_qa,anc_qa,band_qa,lut)
+            else:
+              goodData = brdf_qa != 255
+              # snow mask is True for snow and False for no snow
+              goodData = goodData & (snow_qa!=255)
+              snow_mask    = snow_qa==1
+              no_snow_mask = snow_qa==0
+              #  pull land / sea etc mask 
+              # land / water is bits 4-7
+              land = (( 0b11110000 & anc_qa ) >> 4).astype(np.uint8)
+              # dont want deep ocean
+              goodData = goodData & (land != 7)
+
+              QA = band_qa
+              band_quality = QA & 0b1111
+              QA = QA >> 4
+              goodData = goodData & (band_quality < 4)
+              #this loop might not be needed ...
+              #might get away with just teh first band ...
+              #for k in range(1,1):
+              band_quality2 = QA & 0b1111
+              goodData = goodData & (band_quality2 < 4)
+              QA = QA >> 4
+              # take the max
+              w = band_quality2>band_quality
+              band_quality[w] = band_quality2[w]
+            # now we need the data
+            raw = waitBands()
           else:
             s0,ns,l0,nl = dataw['limits']
-            mask = QA = goodData = dataw['mask']
+            mask = goodData = dataw['mask']
             land = dataw['land']
             weight = dataw['weight']
             snow_mask = dataw['snow_mask']
+            no_snow_mask = dataw['no_snow_mask']
 
-          self.logging.info( 'reading data... %s'%fileName,extra=self.d)
-
-          # open the data file 
-
-          hdf = SD.SD(fileName)
-          # allocate array for all bands
-          data = np.zeros((3, nBands) + QA.shape)
-          # loop over bands 
-          for i in range(nBands):
-            self.logging.info( '  ... band %d'%int(bands[i]),extra=self.d)
-            # Lewis: ensure this is an int
-            sds = hdf.select(int(bands[i]))
-            ithis = np.array(sds.get(start=[s0,l0,0],count=[ns,nl,3]))
-            #filter out duff values
-            for j in range(3):
-              goodData = goodData & (ithis[:,:,j] != duff)
-              data[j,i] = scale * ithis[:,:,j]
-          hdf.end()
+            self.logging.info( 'reading data... %s'%fileName,extra=self.d)
+            raw = readBands(fileName,bands,(s0,ns,l0,nl),np.empty((nBands,ns,nl,3),dtype=np.int16))
+          #filter out duff values over all bands and parameters
+          goodData = goodData & (raw != duff).all(axis=(0,3))
+          # NB this is data[0-3,nb,:,:]
+          # keep the raw integers: scale is applied by the caller
+          data = raw.transpose(3,0,1,2)
 
           #self.logging.info( 'done ...',extra=self.d)
           """     
@@ -601,7 +1274,7 @@ class prep_modis():
           where the QA is determined as the maximum (ie poorest quality) over the wavebands  
           """
 
-          if dataw == None:
+          if dataw is None:
             # snow type filtering
             if snow and no_snow:
               pass
@@ -610,22 +1283,24 @@ class prep_modis():
             elif no_snow:
               goodData = goodData & no_snow_mask
 
-            weight = backupscale ** band_quality
+            if not hasNumba:
+              weight = lut[band_quality]
   
             self.logging.info( ' ...sorting mask...',extra=self.d)
             mask = goodData
-            land      = land * mask
-            weight    = weight * mask
-            snow_mask = snow_mask * mask
-            no_snow_mask = no_snow_mask * mask
+            # apply the mask in place: no new arrays or upcasting
+            land      *= mask
+            weight    *= mask
+            snow_mask &= mask
+            no_snow_mask &= mask
             # NB this changes the data set shape around
             # so its data[0-3,nb,:,:]
-          data = data * mask
+          data *= mask
 
           retval = {'error':False,'ns':ns,'nl':nl,'nb':nBands,\
                         'land':land,'weight':weight,\
                         'limits':(s0,ns,l0,nl),'no_snow_mask':no_snow_mask,\
-                        'data':data,'mask':goodData,'snow_mask':snow_mask}
+                        'data':data,'scale':scale,'mask':goodData,'snow_mask':snow_mask}
           self.logging.info('done',extra=self.d)
         except:
           retval = {'error':True}
@@ -633,7 +1308,7 @@ class prep_modis():
 
 
 
-    def allocateData(self,nb,ns,nl,nsets,flag):
+    def allocateData(self,nb,ns,nl,nsets,flag,shared=False):
         """
 
         Allocate data for calculating image statistics
@@ -648,38 +1323,245 @@ class prep_modis():
         nb  : long 
               number of bands
         nsets : long
-              number of data sets      
+              number of data sets (the sums are accumulated over the
+              data sets, so this does not affect the array sizes)
+        flag : integer
+              0 to allocate, otherwise return -1 for each item
+        shared : boolean
+              allocate the arrays in shared memory (for multiprocessing)
  
         Returns
         ------- 
 
-        Dictionary containing:
+        Dictionary containing running statistics over the data sets:
         
-        sum  : sum 
-               (weighted by w) for band of nb, kernel of 3, sample of ns, line of nl
-        sum2 : sum^2 
-               (weighted by w^2) for each combination of band/kernel, sample of ns, line of nl
+        mean : mean 
+               (weighted by w) for band of nb, sample of ns, line of nl, kernel of 3
+        m2   : sum of w * (data - mean)^2
+               for each combination of band/kernel, sample of ns, line of nl
         n    : sum of weight 
                for sample of ns, line of nl
+        n2   : sum of weight^2
+               for sample of ns, line of nl
         nSamples : number of samples 
                    per pixel
 
+        The weights are the same for all bands and kernels, so these
+        are only stored per pixel.
+
         """
         # allocate the arrays for mean and variance
         if (flag == 0):
-            
-            data = np.zeros((nsets,nb,ns,nl,3),dtype=np.float32)           
-            n = np.zeros((nsets,nb,ns,nl,3),dtype=np.float32)
-            nSamples = np.zeros((nsets,nb,ns,nl),dtype=np.int)
+            zeros = sharedZeros if shared else np.zeros
+            mean = zeros((nb,ns,nl,3),dtype=np.float32)           
+            m2 = zeros((nb,ns,nl,3),dtype=np.float32)           
+            n = zeros((ns,nl),dtype=np.float32)
+            n2 = zeros((ns,nl),dtype=np.float32)
+            nSamples = zeros((ns,nl),dtype=np.int16)
             self.logging.info( 'numb of bands %d, numb of samples %d, numb of lines %d'%(nb, ns, nl),extra=self.d)
  
         else:
-            data = -1
+            mean = -1
+            m2 = -1
             n = -1
+            n2 = -1
             nSamples = -1
 
-        return dict(n=n, data=data, nSamples=nSamples)
+        return dict(mean=mean, m2=m2, n=n, n2=n2, nSamples=nSamples)
+
+
+    def addSamples(self,sums,samples,lock=None):
+        """
+        Add samples into each of a set of sums
+
+        This makes a single pass over the data for all of the sums:
+        the weighted (block) sums for snow and no snow are
+        formed once, and those for snow and no snow together
+        are just their total.
+
+        Parameters
+        ----------
+
+        sums : list of (isSnow,sumData) tuples
+               see incrementSamples()
+        samples : dictionary from getModisAlbedo()
+               with data[0-3,nb,ns,nl], weight[ns,nl],
+               snow_mask[ns,nl] and no_snow_mask[ns,nl]
+        lock : lock (optional)
+               held only while the sums are updated, so the
+               weighting can run in parallel with other workers
+
+        Returns
+        -------
+
+        None
+
+        """
+        data = samples['data']
+        if data.shape != (3,samples['nb'],samples['ns'],samples['nl']):
+          raise ValueError('samples data shape %s is not [3,nb,ns,nl]'%str(data.shape))
+        # the sums are [nb,ns,nl,3]: a view, not a copy
+        data = data.transpose(1,2,3,0)
+        scale = samples['scale']
+        # copy, as we change it
+        samplesN = samples['weight'].astype(np.float32)
+        # sum f0 over all bands
+        f0sum = samples['data'][0].sum(axis=0)
+        # find where == 0  as f0 == 0 is likely dodgy     
+        bad = (f0sum<=0) & (samplesN>0)
+        nbad = np.count_nonzero(bad)
+        if nbad:
+          self.logging.info("deleting %d samples that are zero"%nbad,extra=self.d)
+          samplesN[bad] = 0
+
+        wanted = [isSnow for isSnow,sumData in sums]
+        fuse = (0 in wanted) and (1 in wanted) and (2 in wanted)
+        blocks = {}
+        for isSnow in wanted:
+          if isSnow == 2 and fuse:
+            continue
+          # generate the masks of where we have data (that we want)
+          if (isSnow == 0):
+              # no snow only
+              keep = samples['no_snow_mask']
+          elif (isSnow == 1):
+              # snow only
+              keep = samples['snow_mask']
+          else:
+              keep = samples['snow_mask'] | samples['no_snow_mask']
+
+          thisN = samplesN*keep
+          self.logging.info('N %.2f'%thisN.sum(),extra=self.d)
+          # save some time on duffers
+          if thisN.sum() == 0:
+            blocks[isSnow] = None
+          else:
+            blocks[isSnow] = self.weightedBlocks(data,scale,thisN)
+
+        if fuse:
+          # snow and no snow together
+          if blocks[0] is None or blocks[1] is None:
+            both = blocks[0] or blocks[1]
+            blocks[2] = both and (both[0].copy(),both[1].copy())
+          elif self.shrink == 1:
+            # the snow and no snow pixels are distinct, and the
+            # means are 0 where there is no weight, so they just add
+            blocks[2] = (blocks[0][0]+blocks[1][0],blocks[0][1]+blocks[1][1])
+          else:
+            # weighted mean of the snow and no snow block means
+            sweight = blocks[0][1]+blocks[1][1]
+            r = np.zeros_like(sweight)
+            np.divide(blocks[0][1],sweight,out=r,where=sweight>0)
+            r = r[np.newaxis,:,:,np.newaxis]
+            xdata = blocks[0][0]*r
+            xdata += blocks[1][0]*(1-r)
+            blocks[2] = (xdata,sweight)
+
+        if lock is not None:
+          lock.acquire()
+        try:
+          for isSnow,sumData in sums:
+            if blocks[isSnow] is None:
+              self.logging.info('No samples here ...',extra=self.d)
+            else:
+              xdata,sweight = blocks[isSnow]
+              self.updateStats(sumData,xdata,sweight)
+        finally:
+          if lock is not None:
+            lock.release()
+
+    def weightedBlocks(self,data,scale,samplesN):
+        """
+        Weighted mean of the data over shrink x shrink blocks
+
+        Parameters
+        ----------
+
+        data : integer array (nb,ns,nl,3)
+               raw data from getModisAlbedo() (as [nb,ns,nl,0-3])
+        scale : float
+               scale to apply to data
+        samplesN : float array (ns,nl)
+                   weight of each sample (0 for those not wanted)
+
+        Returns
+        -------
+
+        xdata : float array (nb,ns/shrink,nl/shrink,3)
+                 scaled weighted (block) mean of the data
+                 (0 where there is no weight)
+        sweight : float array (ns/shrink,nl/shrink)
+                 sum of weight
+
+        """
+        nb,ns,nl = data.shape[:3]
+
+        k = self.shrink
+        if k == 1:
+          # nothing to shrink: the mean is just the (scaled) data
+          sweight = samplesN
+          xdata = np.multiply(data,(scale*(samplesN>0))[np.newaxis,:,:,np.newaxis],dtype=np.float32)
+        else:
+          # crop to a whole number of shrink x shrink blocks
+          ms = (ns/k)*k
+          ml = (nl/k)*k
+
+          # the weight is the same for all bands and parameters
+          # so just broadcast it rather than storing nb*3 copies
+          weight = samplesN[np.newaxis,:ms,:ml,np.newaxis]
+
+          # so sweightdata is the observations multiplied by the weight
+          sweightdata = data[:,:ms,:ml]*weight
+
+          # shrink the data: sum over k x k blocks
+          sweight = samplesN[:ms,:ml].reshape(ms/k,k,ml/k,k).sum(axis=(1,3))
+          xdata = sweightdata.reshape(nb,ms/k,k,ml/k,k,3).sum(axis=(2,4))
+          xdata *= scale
+          # sum of weight * data / sum of weight
+          w = sweight[np.newaxis,:,:,np.newaxis]
+          np.divide(xdata,w,out=xdata,where=w>0)
+        return xdata,sweight
+
+    def updateStats(self,sumData,xdata,sweight):
+        """
+        Update the running stats in sumData with one (weighted) data set
+
+        Parameters
+        ----------
+
+        sumData : dictionary
+                  Containing ``mean``, ``m2``, ``n``, ``n2`` and ``nSamples``
+        xdata : float array (nb,ns,nl,3)
+                 (block) mean of the data for this set (overwritten)
+        sweight : float array (ns,nl)
+                 sum of weight
+
+        Returns
+        -------
 
+        None
+
+        """
+        # West's weighted incremental update of the mean and M2
+        # (the sum of w * (data - mean)^2), in place. The update
+        # factors only depend on the weights, so are per pixel
+        n = sumData['n']
+        ntot = n + sweight
+        r = np.zeros_like(ntot)
+        np.divide(sweight,ntot,out=r,where=ntot>0)
+        q = r*n
+        if hasNumba:
+          with kernelLock:
+            welfordUpdate(sumData['mean'],sumData['m2'],xdata,r,q)
+        else:
+          delta = np.subtract(xdata,sumData['mean'],out=xdata)
+          sumData['mean'] += delta*r[np.newaxis,:,:,np.newaxis]
+          np.square(delta,out=delta)
+          delta *= q[np.newaxis,:,:,np.newaxis]
+          sumData['m2'] += delta
+        sumData['n'] += sweight
+        sumData['n2'] += sweight*sweight
+        sumData['nSamples'] += sweight > 0
 
     def incrementSamples(self,sumData,samples,isSnow,index):
         """
@@ -687,17 +1569,16 @@ class prep_modis():
 
         The data here are in samples (a dictionary).
 
-        The snow mask is in data['isSnow'] != -1
-        i.e. this is set to -1 for 'no data'
-        It is set to 1 if a pixel is 'snow' and 0 if snow free
+        The snow masks are in samples['snow_mask'] (snow) and
+        samples['no_snow_mask'] (snow free): pixels in neither are 'no data'
 
         Parameters
         ----------
 
         sumData : dictionary
-                  Containing ``sum``, ``sum2``, ``n`` and ``nSamples`` that we wish to accumulate into
-        samples : dictionary
-                  Containing ``sum``, ``sum2``, ``n`` and ``nSamples`` that are the values to be added to sumData
+                  Containing ``mean``, ``m2``, ``n``, ``n2`` and ``nSamples`` that we wish to accumulate into
+        samples : dictionary from getModisAlbedo()
+                  see addSamples()
         isSnow : integer
                  Code for snow processing type. The flag isSnow is used to determine the type of coverage:
           0 : no snow only
@@ -705,79 +1586,19 @@ class prep_modis():
           2 : snow and no snow together
 
          index : integer
-                 dataset index
+                 dataset index (not used: the sums are accumulated in place)
 
         Returns
         --------
 
         sumData : dictionary
-                  With ``data``, ``n`` and ``nSamples`` in the arrays
+                  With ``mean``, ``m2``, ``n``, ``n2`` and ``nSamples`` updated
 
         """
-        ns = samples['ns']
-        nl = samples['nl']
-        nb = samples['nb']
-
-       
-        # generate some negative masks 
-        if (isSnow == 0):
-            # no snow only
-            w = np.where(samples['isSnow'] != 0)
-        elif (isSnow == 1):
-            # snow only
-            w = np.where(samples['isSnow'] != 1)
-        else:
-            w = np.where(samples['isSnow'] == -1)
-
-        # so w is a mask of where we *dont* have data (that we want)
-        samplesN = samples['N'].copy()
-        samplesN[w] = 0
-
-        # sum f0 over all bands
-        f0sum = samples['data'][:,:,:,0].sum(axis=0)
-        # find where == 0  as f0 == 0 is likely dodgy     
-        w = np.where((f0sum<=0) & (samplesN>0))
-        if len(w)>0 and len(w[0])>0:
-          self.logging.info('N %.2f'%samplesN.sum(),extra=self.d)
-          self.logging.info("deleting %d samples that are zero"%len(w[0]),extra=self.d)
-          samplesN[w] = 0
-          self.ogging.info('N %.2f'%samplesN.sum(),extra=self.d)
-        else:
-          self.logging.info('N %.2f'%samplesN.sum(),extra=self.d)
-        # save some time on duffers
-        if samplesN.sum() == 0:
-          self.logging.info('No samples here ...',extra=self.d)
-          return sumData
-
-        weight = np.zeros((nb,ns,nl,3),dtype=np.float32)
-
-        for i in range(nb):
-            for j in range(3):
-                weight[i,:,:,j] = samplesN
-
-        # shrink the data
-        sweight = np.zeros((nb,ns/self.shrink,nl/self.shrink,3),dtype=float)
-        sdata = np.zeros((nb,ns/self.shrink,nl/self.shrink,3),dtype=float)
-
-        # so sweightdata is the observations multiplied by the weight
-        sweightdata = samples['data']*weight
-        for i in xrange(nb):
-          for j in xrange(3):
-            sweight[i,:,:,j] = self.shrunk(weight[i,:,:,j],ns,nl,self.shrink)
-            sdata[i,:,:,j] = self.shrunk(sweightdata[i,:,:,j],ns,nl,self.shrink)
-            ww = np.where(sweight[i,:,:,j]>0)
-            sdata[i,:,:,j][ww] /= sweight[i,:,:,j][ww]
-        # now sdata is re-normalised so its just the data again
-
-        # store the data
-        sumData['n'][index,...] = sweight
-        sumData['nSamples'][index,...] = (sweight[:,:,:,0] > 0).astype(int)
-        sumData['data'][index,...] = sdata
-
+        self.addSamples([(isSnow,sumData)],samples)
         return sumData
 
 
-
     def processAlbedo(self,yearList,doy,sdmins):
         """
          For some given doy, read and process MODIS kernel data 
@@ -848,77 +1669,86 @@ class prep_modis():
         for i in xrange(len(a1Files)):
            self.logging.info('  %d %s %s'%(i,str(a1Files[i]),str(a2Files[i])),extra=self.d)
 
-        foundOne = False
-        thisOne = 0
-        # try to file at least one file that works ...
-        while not foundOne: 
-          thisData = self.getModisAlbedo(a1Files[thisOne],a2Files[thisOne],\
-                          sdmins,np.asarray(self.backupscale)*weighting[thisOne])
-          if thisData['err'] != 0:
-            thisOne += 1
-            self.logging.warning('error in getModisAlbedo for %s %s'%(a1Files[thisOne],a2Files[thisOne]),extra=self.d)
-            # try another one?
-            if thisOne == len(a1Files):
-              self.logging.error('error in getModisAlbedo: No valid data files found')
-              thisData['err'] = 1
-              return False,0,0,0,0,nb, ns, nl, 0
-          else:
-            foundOne = True
+        nsets = len(a1Files)
+        if nsets == 0:
+          self.logging.error('error in file specification: zero length list of files a1Files',extra=self.d)
+          return False,0,0,0,0,0,0,0,0
 
-        ns = thisData['ns']
-        nl = thisData['nl']
-        nb = thisData['nb']
-        totalSnow = 0
-        #set up arrays for sum, n and sum2
-        self.logging.info('data allocation',extra=self.d)
         dontsnow = self.ip.dontsnow
         dontnosnow = self.ip.dontnosnow 
         dontwithsnow = self.ip.dontwithsnow 
- 
-        nsets = len(a1Files)
-        if nsets == 0:
-          self.logging.error('error in file specification: zero length list of files a1Files',extra=self.d)
-          thisData['err'] = 1
-          return False,0,0,0,0,nb, ns, nl, 0
+        countSnow = (dontsnow == 0 or dontwithsnow == 0)
+        totalSnow = 0
+
+        jobs = [(self,a1Files[i],a2Files[i],sdmins,self.backupscale) for i in xrange(nsets)]
+
+        # the first QA file that opens sets the data size. Only the
+        # dimensions are read here: no (parallel) numba kernels
+        # may run in this process before the pool below is forked,
+        # as the forked workers can then hang (e.g. with GNU OpenMP)
+        for i in xrange(nsets):
+            try:
+                s0,ns,l0,nl = self.readDims(a2Files[i],sdmins)
+                break
+            except:
+                self.logging.warning( 'warning opening file: %s'%str(a2Files[i]),extra=self.d)
+        else:
+          self.logging.error('error in getModisAlbedo: No valid data files found',extra=self.d)
+          return False,0,0,0,0,0,0,0,0
 
+        nb = len(self.bands)
+        # with a pool, the sums go in shared memory and the workers
+        # add into them, so only small results come back from the workers
+        shared = self.nproc > 1
+        #set up arrays for sum, n and sum2
+        self.logging.info('data allocation',extra=self.d)
         try:
-          sumDataSnow = self.allocateData(nb,ns/self.ip.shrink,nl/self.ip.shrink,nsets,dontsnow)
-          sumDataNoSnow = self.allocateData(nb,ns/self.ip.shrink,nl/self.ip.shrink,nsets,dontnosnow)
-          sumDataWithSnow = self.allocateData(nb,ns/self.ip.shrink,nl/self.ip.shrink,nsets,dontwithsnow)
+          sumDataSnow = self.allocateData(nb,ns/self.ip.shrink,nl/self.ip.shrink,nsets,dontsnow,shared=shared)
+          sumDataNoSnow = self.allocateData(nb,ns/self.ip.shrink,nl/self.ip.shrink,nsets,dontnosnow,shared=shared)
+          sumDataWithSnow = self.allocateData(nb,ns/self.ip.shrink,nl/self.ip.shrink,nsets,dontwithsnow,shared=shared)
         except:
           self.logging.error('error in memory allocation: nb %d ns %d nl %d nsets %s'%(nb,ns/self.ip.shrink,nl/self.ip.shrink,nsets),extra=self.d)
           return False,0,0,0,0,nb, ns, nl, 0 
-
-        land = np.zeros((ns,nl),dtype='bool') 
- 
-        if dontsnow == 0 or dontwithsnow == 0:
-            totalSnow = thisData['nSnow']
-            self.logging.info('n snow %d'%totalSnow,extra=self.d)
-
-        for i in range(len(a1Files)):
-            self.logging.info( 'file %d/%d'%(i,len(a1Files)),extra=self.d)
+        sums = [(isSnow,sumData) for isSnow,sumData,dont in \
+                  ((1,sumDataSnow,dontsnow),(0,sumDataNoSnow,dontnosnow),(2,sumDataWithSnow,dontwithsnow)) \
+                  if dont == 0]
+
+        # Lewis: sort the land info
+        land = np.zeros((ns,nl),dtype=bool)
+        self.logging.info( '... incrementing samples',extra=self.d)
+
+        # all of the files: imap gives them back in file order
+        if shared and nsets > 1:
+          # the workers are forked, so they share the sums
+          pool = multiprocessing.Pool(self.nproc,initializer=initAccumulate,\
+                            initargs=(self,sums,multiprocessing.Lock(),self.nproc),maxtasksperchild=4)
+          # so the jobs dont need to carry self
+          results = pool.imap(accumulateAlbedo,[job[1:] for job in jobs])
+        else:
+          # e.g. in a runPart worker: read the next file
+          # while this one is added into the sums
+          pool = None
+          initAccumulate(self,sums,threading.Lock())
+          results = (accumulateData(self,thisData) for thisData in readAhead(readAlbedo,jobs))
+        ngood = 0
+        for i,thisData in enumerate(results):
+            self.logging.info( 'file %d/%d'%(i,nsets),extra=self.d)
             self.logging.info( 'doy %s %s'%(str(doy[0]),str(a1Files[i])),extra=self.d)
-            #only read if i > 1 as we have read first file above
-            if (i != thisOne):
-                thisData = self.getModisAlbedo(a1Files[i],a2Files[i],sdmins,\
-                                     np.asarray(self.ip.backupscale)*weighting[i])
-            if (thisData['err'] != 0):
+            if thisData['error']:
                 self.logging.warning( 'warning opening file: %s'%str(a1Files[i]),extra=self.d)
-            else:
-                # Lewis: sort the land info
-                land = (land | (thisData['land'] == 1))
-                
-                self.logging.info( '... incrementing samples',extra=self.d)
-                if (dontsnow == 0):
-                    sumDataSnow = self.incrementSamples(sumDataSnow,thisData,1,i)
-                if (dontnosnow == 0):
-                    sumDataNoSnow = self.incrementSamples(sumDataNoSnow,thisData,0,i)
-                if (dontwithsnow == 0):
-                    sumDataWithSnow = self.incrementSamples(sumDataWithSnow,thisData,2,i)
-                if (dontsnow == 0 or dontwithsnow == 0):
-                    totalSnow += thisData['nSnow']
-                #self.logging.info( 'done',extra=self.d)
-        
+                continue
+            ngood += 1
+            land |= thisData['land']
+            if countSnow:
+                totalSnow += thisData['nSnow']
+                self.logging.info('n snow %d'%totalSnow,extra=self.d)
+        if pool is not None:
+          pool.close()
+          pool.join()
+        initAccumulate(None,None,None)
+        if ngood == 0:
+          self.logging.error('error in getModisAlbedo: No valid data files found',extra=self.d)
+          return False,0,0,0,0,0,0,0,0
     
         return True,totalSnow, sumDataNoSnow, sumDataSnow, sumDataWithSnow, nb, ns, nl, land
 
@@ -948,59 +1778,63 @@ class prep_modis():
         self.increment_samples()
 
         """
-        focus = np.array(self.weighting)
         self.logging.info("sorting data arrays ...",extra=self.d)
         n = sumData['n']
-        data = sumData['data']
         nSamples = sumData['nSamples']
         #self.logging.info("...done",extra=self.d)
 
-        sumN = np.sum(nSamples,axis=0)
-        ww = np.where(sumN>0)
+        # the weights are per pixel: broadcast them over bands and kernels
+        ww = nSamples>0
+        valid = ww[np.newaxis,:,:,np.newaxis]
 
         #if not (focus == 1).all():
         #  # weight the n terms
         #  for i in xrange(len(focus)):
         #    n[i,...] *= focus[i]
 
-        total = np.sum(data*n,axis=0)
-        ntot = np.sum(n,axis=0)
-        ntot2 = np.sum(n**2,axis=0)
-        meanData = np.zeros_like(total)
-        meanData[ww] = total[ww]/ntot[ww]
-        diff = data - meanData
-        d2 = n*(diff**2)
-        var = np.sum(d2,axis=0)
+        meanData = sumData['mean']
+        ntot = n[np.newaxis,:,:,np.newaxis]
+        ntot2 = sumData['n2'][np.newaxis,:,:,np.newaxis]
+        # sum of n * (data - mean)^2
+        m2 = sumData['m2']
         #var[ww] /= ntot[ww]
         # small number correction: see ATBD
-        num = (ntot**2 - ntot2)
-        # set all valid to min err
-        store = np.zeros_like(var)
-        store[ww] = np.sqrt(self.minvar)
-        store[var>0] = var[var>0]
-        var = store
-        # now fill in
-        num = ntot**2 - ntot2
-        ww = np.where(num>0)
-        var[ww] = ntot[ww] * var[ww]/num[ww]
+        num = np.square(ntot)
+        num -= ntot2
+        # set all with no spread to min err
+        var = np.empty_like(m2)
+        var.fill(np.sqrt(self.minvar))
+        np.copyto(var,m2,where=m2>0)
+        # now fill in: var * ntot / num
+        ok = num>0
+        np.multiply(var,ntot,out=var,where=ok)
+        np.divide(var,num,out=var,where=ok)
         # sqrt
-        sdData = np.sqrt(var)
-        ww = np.where(sumN>0)
-        samp = sdData[ww]
-        sqmax = np.sqrt(self.maxvar)
-        sdData[ww][samp==0.] = np.sqrt(self.minvar)
-        sdData[ww][samp>sqmax] = sqmax
+        sdData = np.sqrt(var,out=var)
+        np.clip(sdData,np.sqrt(self.minvar),np.sqrt(self.maxvar),out=sdData)
+        # invalid pixels are 0
+        sdData *= valid
           
-        return ntot, meanData, sdData
+        return n, meanData, sdData
 
 
-    def rebin(self,a,shape):
+    def rebin(self,a,shape,dtype=None):
         """
-        python equivalent of IDL rebin, copied from
+        python equivalent of IDL rebin, after
         stackoverflow.com/questions/8090229/resize-with-averaging-or-rebin-a-numpy-2d-array
+
+        The block sums are done in one pass with einsum (bool and
+        integer input is summed as float), in dtype if given.
+        Masked values count as 0.
         """
-        sh = shape[0],a.shape[0]//shape[0],shape[1],a.shape[1]//shape[1]
-        return a.reshape(sh).mean(-1).mean(1)
+        a = ma.filled(a,0)
+        f1 = a.shape[0]//shape[0]
+        f2 = a.shape[1]//shape[1]
+        sh = shape[0],f1,shape[1],f2
+        dtype = dtype or np.result_type(a.dtype,np.float32)
+        out = np.einsum('ijkl->ik',a.reshape(sh),dtype=dtype,casting='same_kind')
+        out *= 1.0/(f1*f2)
+        return out
 
 
     def shrunk(self,fdata,ns,nl,shrink,sdata=None):
@@ -1038,44 +1872,52 @@ class prep_modis():
                 derived from fdata but shrunk by `shrink` factor
                 where shrinking produces a local mean, ignoring zero values
 
-        Or, if ``sdata != None``, then in addition
+        Or, if ``sdata is not None``, then in addition
 
         osdata : float array
                  Shrunk std dev array
 
         """
         if shrink == 1:
-          if sdata != None:
+          if sdata is not None:
             return fdata,sdata
           else:
             return fdata
-        if sdata != None:
-          var = sdata**2
+        # masked values count as 0 (missing), on both the numba and numpy paths
+        fdata = ma.filled(fdata,0)
+        if sdata is not None:
+          sdata = ma.filled(sdata,0)
+          # everything is done in float32
+          if hasNumba:
+            odata = np.empty((ns/shrink,nl/shrink),dtype=np.float32)
+            osdata = np.empty_like(odata)
+            with kernelLock:
+              return shrinkSdKernel(fdata,sdata,shrink,odata,osdata)
+          var = np.square(sdata,dtype=np.float32)
           var[fdata==0] = 0.
+          valid = var>0
           vscale = np.zeros_like(var)
-          w = np.where(var>0)
-          vscale[w] = 1./var[w]
-          idata = fdata * vscale
+          np.divide(1.,var,out=vscale,where=valid)
+          idata = np.multiply(fdata,vscale,dtype=np.float32)
           shrunkData = self.rebin(idata,(ns/shrink,nl/shrink))
           shrunkVar = self.rebin(vscale,(ns/shrink,nl/shrink))
-          w = np.where(shrunkVar>0)
+          w = shrunkVar>0
           odata = np.zeros_like(shrunkData)
-          odata[w] = shrunkData[w]/shrunkVar[w]
-          mdata = np.zeros_like(fdata)
-          w1 = np.where(var>0)
-          mdata[w1] = 1
-          n = self.rebin(mdata,(ns/shrink,nl/shrink))
+          np.divide(shrunkData,shrunkVar,out=odata,where=w)
+          n = self.rebin(valid,(ns/shrink,nl/shrink))
           osdata = np.zeros_like(shrunkData)
-          osdata[w] = np.sqrt(n[w]/(shrunkVar[w]))
+          np.divide(n,shrunkVar,out=osdata,where=w)
+          np.sqrt(osdata,out=osdata)
           return odata,osdata
         # else, rescale and account for zeros
-        odata = self.rebin(fdata,(ns/shrink,nl/shrink))
-        w = np.where(fdata == 0)
-        mdata = np.ones_like(fdata)
-        mdata[w] = 0
-        n = self.rebin(mdata,(ns/shrink,nl/shrink))
-        w2 = np.where((n > 0) & (n < 1))
-        odata[w2] /= n[w2]
+        if hasNumba:
+          odata = np.empty((ns/shrink,nl/shrink),dtype=np.float32)
+          with kernelLock:
+            return shrinkKernel(fdata,shrink,odata)
+        odata = self.rebin(fdata,(ns/shrink,nl/shrink),dtype=np.float32)
+        # fraction of non-zero values
+        n = self.rebin(fdata != 0,(ns/shrink,nl/shrink))
+        np.divide(odata,n,out=odata,where=(n > 0) & (n < 1))
 
         return odata
 
@@ -1133,30 +1975,37 @@ class prep_modis():
         except:
           self.logging.warning("Failed to read Netcdf file %s"%filename,extra=self.d)
           
-        bNames = self.idSamples(nb)
-        meanNames = np.array(bNames)[np.where(['MEAN: ' in i for i in bNames])].tolist()
-        sdNames = np.array(bNames)[np.where(['SD: ' in i for i in bNames])].tolist()
-        nNames = ['Weighted number of samples']
-        lNames = ['land mask']
-        mean = []
-        for b in meanNames:
-          mean.append(ncfile.variables[b][:])   
-        sd = []
-        for b in sdNames:
-          sd.append(ncfile.variables[b][:])
-        n = ncfile.variables[nNames[0][:]] 
-        l = ncfile.variables[lNames[0][:]]
-        return np.array(mean),np.array(sd),np.array(n),np.array(l)
-
-
-    def writeNetCdf(self,ns,nl,nb,mean,sd,n,land,snowType,doy):
+        bNames,meanNames,sdNames = self.sampleNames(nb)
+        nNames = ('Weighted number of samples',)
+        lNames = ('land mask',)
+        variables = ncfile.variables
+        # read straight into the output arrays, and
+        # skip the masked array construction
+        for b in meanNames + sdNames + nNames + lNames:
+          variables[b].set_auto_mask(False)
+        ns,nl = variables[meanNames[0]].shape
+        mean = np.empty((len(meanNames),ns,nl),dtype=np.float32)
+        for k,b in enumerate(meanNames):
+          mean[k] = variables[b][:]
+        sd = np.empty((len(sdNames),ns,nl),dtype=np.float32)
+        for k,b in enumerate(sdNames):
+          sd[k] = variables[b][:]
+        n = variables[nNames[0]][:]
+        l = variables[lNames[0]][:]
+        ncfile.close()
+        return mean,sd,n,l
+
+
+    def writeNetCdf(self,ns,nl,nb,mean,sd,n,land,snowType,p,doy):
         """
 
         write mean and var/covar of MODIS albedo datasets to file (NetCDF format)
         filenames are of form
-        OPDIR + '/' + 'Kernels.' + doy + '.' + version + '.' + tile  + '.' + Snowtype
+        OPDIR + '/' + 'Kernels.' + doy + '.' + version + '.' + tile  + '.' + Snowtype + '.' + p
 
-        If self.ip.compression is set, an attenpt is made to compress the netCDF file.
+        (p as 2 digits, to match readNetCdf)
+
+        If self.ip.compression is set, the variables are compressed (zlib).
 
         Parameters
         ----------
@@ -1177,6 +2026,8 @@ class prep_modis():
                land mask
         snowType : string
                e.g. SnowAndNoSnow, used in filename
+        p : integer
+             image part number
         doy  : string
              DOY string e.g. 009
 
@@ -1188,14 +2039,13 @@ class prep_modis():
         """
 
         shrink = self.shrink
+        p = '%02d'%p
         doy = '%03d'%int(doy)
 
         filename = self.ip.opdir + '/Kernels.' + doy + '.' + self.ip.version + '.' +\
-                                 self.ip.tile + '.' + snowType +'.nc'
+                                 self.ip.tile + '.' + snowType +'.'+ p + '.nc'
 
-        bNames = self.idSamples(nb)
-        bNames.append('Weighted number of samples')
-        bNames.append('land mask')
+        bNames = self.sampleNames(nb)[0] + ('Weighted number of samples','land mask')
      
         self.logging.info( 'writing %s'%filename,extra=self.d)
         if nb == 2:
@@ -1214,21 +2064,31 @@ class prep_modis():
         ncfile.createDimension('ns',ns)
         ncfile.createDimension('nl',nl)
         
+        # each variable is written in one go, so use large chunks
+        # and light compression. The mean reflectances are in units
+        # of 1/1000 so we only need keep 3 decimal places for them,
+        # but the SDs and n are kept at full precision (small SDs
+        # matter, as stage 2 weights by 1/sd^2). Byte shuffling
+        # before deflate compresses the floats better.
+        opts = dict(zlib=bool(self.ip.compression),complevel=1,\
+                    shuffle=bool(self.ip.compression),\
+                    chunksizes=(min(ns,512),min(nl,512)))
+
         count = 0
         for i in range(nb):
             for j in range(3):
-                data = ncfile.createVariable(bNames[count],'f4',('ns','nl'),zlib=True,least_significant_digit=10)
+                data = ncfile.createVariable(bNames[count],'f4',('ns','nl'),least_significant_digit=3,**opts)
                 data[:] = mean[j,i]
                 count = count +1
-                data = ncfile.createVariable(bNames[count],'f4',('ns','nl'),zlib=True,least_significant_digit=10)
+                data = ncfile.createVariable(bNames[count],'f4',('ns','nl'),**opts)
                 data[:] = sd[j,i]
                 count = count + 1
       
-        data = ncfile.createVariable(bNames[count],'f4',('ns','nl'),zlib=True,least_significant_digit=10)
-        data[:] = weight
+        data = ncfile.createVariable(bNames[count],'f4',('ns','nl'),**opts)
+        data[:] = n
         count = count + 1
         
-        data = ncfile.createVariable(bNames[count],'f4',('ns','nl'),zlib=True,least_significant_digit=2)
+        data = ncfile.createVariable(bNames[count],'f4',('ns','nl'),least_significant_digit=2,**opts)
         data[:] = land
 
         setattr(ncfile,'description',descrip)
@@ -1239,12 +2099,6 @@ class prep_modis():
           ncfile.close()
         except:
           pass
-        if(False and (self.ip.compression == 1)):
-          try:
-            from subprocess import call
-            call(['gzip','-f',filename])
-          except:
-            self.logging.info( "Failed to compress output file %s"%filename,extra=self.d)
     
 
     def runAll(self):
@@ -1296,87 +2150,96 @@ class prep_modis():
         else:
           doyList = self.ip.doyList
 
+        # each doy and image part is independent (separate input
+        # reads and output files), so run them in parallel.
+        # Each worker then reads its files serially, as daemonic
+        # pool workers cannot start a pool of their own
+        jobs = [(doy,p) for doy in doyList for p in range(self.ip.part)]
+        nproc = min(len(jobs),self.nproc)
+        if nproc > 1:
+          pool = multiprocessing.Pool(nproc,initializer=shareThreads,initargs=(nproc,))
+          pool.map(runPart,[(self,doy,p,isRST) for doy,p in jobs],chunksize=1)
+          pool.close()
+          pool.join()
+        else:
+          for doy,p in jobs:
+            self.processPart(doy,p,isRST)
+
+    def processPart(self,doy,p,isRST=False):
+        """
+        Read the stats for one doy and image part from the netCDF
+        files, or process the MODIS data and write them if that fails
+
+        Parameters
+        ----------
+        doy   : integer
+                day of year to process
+        p     : integer
+                image part number
+        isRST : boolean
+                also write RST files
+
+        Returns
+        -------
+
+        None
+
+        """
+        self.logging.info("DOY %s part %d"%(str(doy),p),extra=self.d)
         ok = True
-        for doy in doyList:
-          self.logging.info("DOY %s"%str(doy),extra=self.d)
-          dimy=2400
-          biny=dimy/self.ip.part
-
-          # try reading the data from CDF files
-          if self.ip.clean == False:
-            for p in range(self.ip.part):
-              nb = len(self.ip.bands)
-              # try reading the data unless --clean
-              try:
-                if (self.ip.dontwithsnow == False):
-                  mean, sdData, n, land = self.readNetCdf(nb,'SnowAndNoSnow',p,doy)
-                  (nb,ns,nl) = mean.shape;nb/=3
-                  # write RST file, but dont shrink the data again
-                  if isRST:
-                    self.writeRST(ns,nl,nb,mean,sdData,n,land,'SnowAndNoSnow',p,doy,shrink=1,order=1)
-              except:
-                ok = False
-              # try reading the data unless --clean
-              try:
-                if (self.ip.dontsnow == False):
-                  mean, sdData, n, land = self.readNetCdf(nb,'Snow',p,doy)
-                  (nb,ns,nl) = mean.shape;nb/=3
-                  if isRST:
-                    self.writeRST(ns,nl,nb,mean,sdData,n,land,'Snow',p,doy,shrink=1,order=1)
-              except:
-                ok = False
-              # try reading the data unless --clean
-              try:
-                if (self.ip.dontnosnow == False):
-                  mean, sdData, n, land = self.readNetCdf(nb,'NoSnow',p,doy)
-                  (nb,ns,nl) = mean.shape;nb/=3
-                  if isRST:
-                    self.writeRST(ns,nl,nb,mean,sdData,n,land,'NoSnow',p,doy,shrink=1,order=1)
-              except:
-                ok = False
-
-          # don't do multiple parts as yet .. use --sdmims instead
-          if not ok: 
-           for p in range(self.ip.part):
-            self.logging.info( "\n\n-------- partition %d/%d --------"%(p,self.ip.part),extra=self.d)
-            y0=p*biny
-            #sdimsL=[-1, -1, -1, -1]
-            sdimsL = self.sdims
-            if self.ip.part>1:
-              sdimsL[2]=y0
-              sdimsL[3]=biny
-            self.logging.info("sub region: %s"%str(sdimsL),extra=self.d)
-
-            processed,totalSnow,sumDataNoSnow,sumDataSnow,sumDataWithSnow,nb,ns,nl,land = \
-                                self.processAlbedo(self.years,[doy],sdimsL)
-          
-            if processed: 
-              land = self.shrunk(land,ns,nl,self.ip.shrink)
-              ns /= self.ip.shrink
-              nl /= self.ip.shrink
-
-              self.logging.info('... calculating stats',extra=self.d)
-              n = np.zeros((nb,ns,nl,3),dtype=np.float32)
-              mean = np.zeros((nb,ns,nl,3),dtype=np.float32)
-              sdData = np.zeros((nb,ns,nl,3),dtype=np.float32)
-
-              if (self.ip.dontwithsnow == False):
-                n, mean, sdData = self.calculateStats(sumDataWithSnow)
-                self.writeNetCdf(ns,nl,nb,mean,sdData,n,land,'SnowAndNoSnow',p,doy)
-                if isRST:
-                  self.writeRST(ns,nl,nb,mean,sdData,n,land,'SnowAndNoSnow',p,doy)
- 
-              if self.ip.dontnosnow == False:
-                n, mean, sdData = self.calculateStats(sumDataNoSnow)  
-                self.writeNetCdf(ns,nl,nb,mean,sdData,n,land,'NoSnow',p,doy)
-                if isRST:       
-                  self.writeRST(ns,nl,nb,mean,sdData,n,land,'NoSnow',p,doy)
- 
-              if self.ip.dontsnow == False:
-                n, mean, sdData = self.calculateStats(sumDataSnow)
-                self.writeNetCdf(ns,nl,nb,mean,sdData,n,land,'Snow', p,doy)
-                if isRST:       
-                  self.writeRST(ns,nl,nb,mean,sdData,n,land,'Snow',p,doy)
+        dimy=2400
+        biny=dimy/self.ip.part
+        nb = len(self.ip.bands)
+
+        # try reading the data from CDF files unless --clean
+        if self.ip.clean == False:
+          for snowType,dont in (('SnowAndNoSnow',self.ip.dontwithsnow),\
+                                ('Snow',self.ip.dontsnow),('NoSnow',self.ip.dontnosnow)):
+            if dont:
+              continue
+            try:
+              mean, sdData, n, land = self.readNetCdf(nb,snowType,p,doy)
+              (nb,ns,nl) = mean.shape;nb/=3
+              # write RST file, but dont shrink the data again
+              if isRST:
+                self.writeRST(ns,nl,nb,mean,sdData,n,land,snowType,p,doy,shrink=1,order=1)
+            except:
+              ok = False
+        else:
+          ok = False
+
+        if ok:
+          return
+
+        self.logging.info( "\n\n-------- partition %d/%d --------"%(p,self.ip.part),extra=self.d)
+        y0=p*biny
+        #sdimsL=[-1, -1, -1, -1]
+        # copy, as the parts may be run in parallel
+        sdimsL = list(self.sdim)
+        if self.ip.part>1:
+          sdimsL[2]=y0
+          sdimsL[3]=biny
+        self.logging.info("sub region: %s"%str(sdimsL),extra=self.d)
+
+        processed,totalSnow,sumDataNoSnow,sumDataSnow,sumDataWithSnow,nb,ns,nl,land = \
+                            self.processAlbedo(self.years,[doy],sdimsL)
+        if not processed:
+          return
+
+        land = self.shrunk(land,ns,nl,self.ip.shrink)
+        ns /= self.ip.shrink
+        nl /= self.ip.shrink
+
+        self.logging.info('... calculating stats',extra=self.d)
+        for snowType,dont,sumData in (('SnowAndNoSnow',self.ip.dontwithsnow,sumDataWithSnow),\
+                                      ('NoSnow',self.ip.dontnosnow,sumDataNoSnow),\
+                                      ('Snow',self.ip.dontsnow,sumDataSnow)):
+          if dont:
+            continue
+          n, mean, sdData = self.calculateStats(sumData)
+          self.writeNetCdf(ns,nl,nb,mean,sdData,n,land,snowType,p,doy)
+          if isRST:
+            self.writeRST(ns,nl,nb,mean,sdData,n,land,snowType,p,doy)
 
 
 def processArgs(args=None,parser=None):
@@ -1416,6 +2279,8 @@ def processArgs(args=None,parser=None):
                               '[2000,2001,2002,2003,2004,2005,2006,2007,2008,2009,2010,2011,2012,2013,2014,2015,2016]',help='list of years to process')
     parser.add_option('--version',dest='version',type='string',default='005',help='MODIS collection number (as string). Default 005')
     parser.add_option('--product',dest='product',type='string',default='MCD43A',help='product name (default MCD43A)')
+    parser.add_option('--nproc',dest='nproc',type='int',default=multiprocessing.cpu_count(),\
+                      help="number of processes to use (default: number of CPUs)")
     parser.add_option('--doy',dest='doyList',type='string',default='None',help='list of doys to process e.g. "[1,9]". N.B. do not put leading zeros on the dates (e.g. do not use e.g. [001,009])')
 
     
@@ -1438,139 +2303,175 @@ if __name__ == '__main__':
     # full unique day and year list
     doyList, yearList = self.getDates(self.a1Files)
 
-    # loop over days
-    for d in doyList:
-      # open output file
-      ncfile = None
-
-      # which files for these years & this doy
-      a1,a2 = self.getValidFiles(yearList,d)
-      dummy = False
-      mask = np.zeros(len(a1)).astype(object);mask[:] = None
-      for i,b in enumerate(self.bands):
-        for j,(A1,A2) in enumerate(zip(a1,a2)):
-          # read some data
-          mask[j] = self.translate(A1,A2,bands=[b],data=mask[j])
-          s0,ns,l0,nl = mask[j]['limits']
-
-          if ncfile == None:
-            snowType = (self.snow and self.no_snow and 'SnowAndNoSnow') or\
-                                      (self.snow and 'Snow') or\
-                                      (self.no_snow and 'NoSnow')
-
-            filename = self.opdir + '/Kernels.' + '%03d'%int(d) + '.' + self.version + '.' +\
-                                 self.tile + '.' + snowType +'.nc'
-
-            ncfile = nc.Dataset(filename,'w',format = 'NETCDF3_CLASSIC')
-
-            ncfile.createDimension('ns',ns)
-            ncfile.createDimension('nl',nl)
-
-            descrip = snowType + ' MODIS Mean/SD ' + d + ' over the years ' + str(yearList)  + \
-                ' version ' + self.version + ' tile '+ self.tile + \
-                ' using input MODIS bands '
-            for band in self.bands:
-              descrip = descrip + str(band) + ' '
-
-            nb = len(self.bands)
-            if nb == 2:
-              defBands = [4,1,1]
-            elif nb == 7:
-              defBands = [1,14,19]
+    # loop over days (always removing any memory mapped
+    # staging buffers at the end, even on an error)
+    try:
+      for d in doyList:
+        # open output file
+        ncfile = None
+        f0 = None
+
+        # which files for these years & this doy
+        a1,a2 = self.getValidFiles(yearList,d)
+        dummy = False
+        mask = np.empty(len(a1),dtype=object)
+        for i,b in enumerate(self.bands):
+          for j,(A1,A2) in enumerate(zip(a1,a2)):
+            # read some data
+            mask[j] = self.translate(A1,A2,bands=[b],data=mask[j])
+            s0,ns,l0,nl = mask[j]['limits']
+
+            if ncfile is None:
+              snowType = (self.snow and self.no_snow and 'SnowAndNoSnow') or\
+                                        (self.snow and 'Snow') or\
+                                        (self.no_snow and 'NoSnow')
+
+              filename = self.opdir + '/Kernels.' + '%03d'%int(d) + '.' + self.version + '.' +\
+                                   self.tile + '.' + snowType +'.nc'
+
+              ncfile = nc.Dataset(filename,'w',format = 'NETCDF3_CLASSIC')
+
+              ncfile.createDimension('ns',ns)
+              ncfile.createDimension('nl',nl)
+
+              descrip = snowType + ' MODIS Mean/SD ' + d + ' over the years ' + str(yearList)  + \
+                  ' version ' + self.version + ' tile '+ self.tile + \
+                  ' using input MODIS bands '
+              for band in self.bands:
+                descrip = descrip + str(band) + ' '
+
+              nb = len(self.bands)
+              if nb == 2:
+                defBands = [4,1,1]
+              elif nb == 7:
+                defBands = [1,14,19]
+              else:
+                defBands = [1,10,7]
+
+              setattr(ncfile,'description',descrip)
+              setattr(ncfile,'data ignore value',-1.0)
+              setattr(ncfile,'default bands',defBands)
+
+            # allocate storage
+            if f0 is None:
+              ws = self.getWorkspace(len(a1),ns,nl)
+              f0,f1,f2 = ws['f0'],ws['f1'],ws['f2']
+              snow,no_snow = ws['snow'],ws['no_snow']
+              land,weight = ws['land'],ws['weight']
+
+            if mask[j] is None:
+              goodData = False
+              if dummy is False:
+                dummy = np.zeros((ns,nl),dtype=np.uint16)
+              f0[j] = f1[j] = f2[j] = dummy
             else:
-              defBands = [1,10,7]
-
-            setattr(ncfile,'description',descrip)
-            setattr(ncfile,'data ignore value',-1.0)
-            setattr(ncfile,'default bands',defBands)
-
-          # allocate storage
-          if 'f0' not in locals():
-            f0 = np.zeros((len(a1),ns,nl)).astype(np.uint16)
-            f1 = f0.copy()
-            f2 = f0.copy()
-            snow = f0.copy().astype(bool)
-            no_snow = f0.copy().astype(bool)
-            land = f0.copy().astype(np.uint8)
-            weight = f0.copy()
-
-          if mask[j] == None:
-            goodData = False
-            if dummy == False:
-              dummy = np.zeros((ns,nl)).astype(np.uint16);
-            f0[j] = f1[j] = f2[j] = dummy
-          else:
-            goodData = True
+              goodData = True
        
-            # store the reflectance data for band i
-            # and year implied by A1,A2
-            f0[j] = mask[j]['data'][0,0]
-            f1[j] = mask[j]['data'][1,0]
-            f2[j] = mask[j]['data'][2,0]
-          # delete
-          del mask[j]['data']
+              # store the reflectance data for band i
+              # and year implied by A1,A2
+              f0[j] = mask[j]['data'][0,0]
+              f1[j] = mask[j]['data'][1,0]
+              f2[j] = mask[j]['data'][2,0]
+            # delete
+            del mask[j]['data']
+            if i == 0:
+              if not goodData:
+                if dummy is False:
+                  s0,ns,l0,nl = mask[j]['limits']
+                  dummy = np.zeros((ns,nl),dtype=np.uint16)
+                weight[j] = dummy
+                land[j] = dummy.astype(np.uint8)
+                snow[j] = no_snow[j] = dummy.astype(bool)
+              # store in list
+              weight[j] = mask[j]['weight']
+              land[j] = mask[j]['land']
+              snow[j] = mask[j]['snow_mask']
+              no_snow[j] = mask[j]['no_snow_mask']
+
+          import pdb;pdb.set_trace()
+
           if i == 0:
-            if not goodData:
-              if dummy == False:
-                s0,ns,l0,nl = mask[j]['limits']
-                dummy = np.zeros((ns,nl)).astype(np.uint16);
-              weight[j] = dummy
-              land[j] = dummy.astype(np.uint8)
-              snow[j] = no_snow[j] = dummy.astype(bool)
-            # store in list
-            weight[j] = mask[j]['weight']
-            land[j] = mask[j]['land']
-            snow[j] = mask[j]['snow_mask']
-            no_snow[j] = mask[j]['no_snow_mask']
-
-        import pdb;pdb.set_trace()
-
-        if i == 0:
-          # now we have read all of the data for one band for all years
-          # for the given day
-
-          # sort the land mask (categories 1,2,3)
-          landed = ma.array(land,mask=(land==0))
-          tt = ma.array(np.zeros((3,ns,nl)))
-          for k,t in enumerate([1,2,3]):
-            tt[k] = np.sum((landed == t)*weight,axis=0)
-          ttmask = tt.sum(axis=0) == 0
-          # this is the summary land mask
-          landed = ma.array(np.argmax(tt,axis=0)+1,mask=ttmask)
+            # now we have read all of the data for one band for all years
+            # for the given day
+
+            # sort the land mask (categories 1,2,3):
+            # sum the weight of each category over the years with
+            # one bincount per year (other categories all go in
+            # the single bin 3*npix, which is dropped)
+            npix = ns*nl
+            cats = np.empty(256,dtype=np.intp)
+            cats.fill(3*npix)
+            cats[1:4] = np.arange(3)*npix
+            pix = np.arange(npix)
+            tt = np.zeros(3*npix,dtype=np.float32)
+            for j in xrange(weight.shape[0]):
+              index = cats[land[j].ravel()]
+              index += pix
+              np.minimum(index,3*npix,out=index)
+              bc = np.bincount(index,weights=weight[j].ravel(),minlength=3*npix+1)
+              np.add(tt,bc[:3*npix],out=tt,casting='unsafe')
+            tt = ma.array(tt.reshape(3,ns,nl))
+            ttmask = tt.sum(axis=0) == 0
+            # this is the summary land mask
+            landed = ma.array(np.argmax(tt,axis=0)+1,mask=ttmask)
           
-          ds = ncfile.createVariable('land mask','i1',('ns','nl'),zlib=True)
-          ds[:] = landed
-
-          land_mask = np.array([ttmask.mask]*weight.shape[0]).astype(bool)
-
-          # generate 3 types of weight:
-          # rescale
-          weight = weight.astype(float) * 0.001  
-          if self.snow and self.no_snow:
-            weight = ma.array(weight,mask=~((snow|no_snow) & ~land_mask))
-            sum_weight = weight.sum(axis=0)
-          elif self.snow:
-            weight = ma.array(weight,mask=~((snow) & ~land_mask))
-            sum_weight = weight.sum(axis=0)
-          elif self.no_snow:
-            weight = ma.array(weight,mask=~((no_snow) & ~land_mask))
-            sum_weight = weight.sum(axis=0)
+            ds = ncfile.createVariable('land mask','i1',('ns','nl'),zlib=True)
+            ds[:] = landed
+
+            # pixels with no land (categories 1-3) weight
+            noLand = np.asarray(ttmask)
+
+            # generate the weights one year at a time (from
+            # the staging buffers) and sum them
+            def yearWeight(j,out):
+              # rescaled weight of year j, 0 where masked
+              if self.snow and self.no_snow:
+                keep = snow[j] | no_snow[j]
+              elif self.snow:
+                keep = snow[j].copy()
+              else:
+                keep = no_snow[j].copy()
+              keep &= ~noLand
+              np.multiply(weight[j],np.float32(0.001),out=out)
+              out *= keep
+              return out
+            nyears = weight.shape[0]
+            wj = np.empty((ns,nl),dtype=np.float32)
+            sum_weight = np.zeros((ns,nl),dtype=np.float32)
+            for j in xrange(nyears):
+              sum_weight += yearWeight(j,wj)
+            valid = sum_weight > 0
+            # the variance is normalised by sum_weight - 1
+            sum_weight1 = np.subtract(sum_weight,np.float32(1.))
+            ok = valid & (sum_weight1 != 0)
        
-        params   = [None]*3
-        params_sd = [None]*3
-
-        for k,f in enumerate([f0,f1,f2]):
-          f = f*0.001
-          f_mean = (f * weight).sum(axis=0) / sum_weight
-          diff = f - f_mean
-          f_var = np.sum(weight * diff * diff ,axis=0) / ( sum_weight - 1.)
-          f_var[f_var<0] = np.sqrt(np.max([1.0,f_var.max()]))
-          params[k], params_sd[k] = self.shrunk(f_mean,ns,nl,self.shrink,sdata=np.sqrt(f_var))
-
-      # reset the arrays
-      f0[:] = f1[:] = f2[:] = weight[:] = 0
-      snow[:] = no_snow[:] = False
-      land = np.array(land);land[:] = 0
-      ncfile.close()
-
-
+          params   = [None]*3
+          params_sd = [None]*3
+
+          # weighted mean and variance over the years, one
+          # year at a time, into preallocated outputs
+          fj = np.empty((ns,nl),dtype=np.float32)
+          for k,f in enumerate([f0,f1,f2]):
+            f_mean = np.zeros((ns,nl),dtype=np.float32)
+            for j in xrange(nyears):
+              np.multiply(f[j],np.float32(0.001),out=fj)
+              fj *= yearWeight(j,wj)
+              f_mean += fj
+            np.divide(f_mean,sum_weight,out=f_mean,where=valid)
+            f_var = np.zeros((ns,nl),dtype=np.float32)
+            for j in xrange(nyears):
+              np.multiply(f[j],np.float32(0.001),out=fj)
+              fj -= f_mean
+              np.square(fj,out=fj)
+              fj *= yearWeight(j,wj)
+              f_var += fj
+            np.divide(f_var,sum_weight1,out=f_var,where=ok)
+            f_var[~ok] = 0
+            if ok.any():
+              f_var[ok & (f_var<0)] = np.sqrt(np.max([1.0,f_var[ok].max()]))
+            params[k], params_sd[k] = self.shrunk(f_mean,ns,nl,self.shrink,sdata=np.sqrt(f_var))
+
+        ncfile.close()
+
+    finally:
+      self.releaseWorkspace()